@@ -0,0 +1,104 @@
+import re
+import time
+
+import xss_experiment_pipeline as pipeline
+
+# the original server_sanitize substitutions, applied once each, in order
+OLD_SANITIZE_PASSES = (
+    (re.compile(r'\s+on\w+\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+)', re.I), ""),
+    (re.compile(r'href\s*=\s*(["\'])\s*javascript:[^"\']*\1', re.I), 'href="#"'),
+    (re.compile(r'src\s*=\s*(["\'])\s*data:[^"\']*\1', re.I), ""),
+)
+
+# nested, overlapping and re-forming payloads (a removal splices a new attribute together)
+SANITIZE_PAYLOADS = [
+    '<img oonnerror=alert(1) src=x>',
+    '<img src=x o onerror=alert(1)nerror=alert(2)>',
+    '<a hre onx=1f="javascript:alert(1)">x</a>',
+    '<a href="java onx=1script:alert(1)">x</a>',
+    '<a h onx=1 ref="javascript:x">x</a>',
+    '<img sr onx=1c="data:text/html,x">',
+    '<a hrsrc="data:x"ef="javascript:alert(1)">x</a>',
+    '<img src="data:x onclick=y">',
+    '<a href="javascript:a onclick=b">x</a>',
+    'src="data:href="javascript:x" text',
+    '<img onerror=" onload=x">',
+    '<a x onfoo= onbar=1>x</a>',
+    'plain <b>text</b> with href="javascript:void(0)" in it',
+]
+
+
+def old_sanitize(text):
+    for pattern, repl in OLD_SANITIZE_PASSES:
+        text = pattern.sub(repl, text)
+    return text
+
+
+# every counting pass, so the timing covers the re patterns even when hyperscan would skip some
+ALL_HITS = set(pipeline.XSS_PATTERNS) | {"on_attr_any"}
+
+
+# At this many unclosed openers the old quadratic patterns took seconds (<td[^>]*> about 3.5 s, the old
+# on_attr far longer) while the linear scans take milliseconds, so the generous bound below separates
+# them regardless of machine load.
+UNCLOSED_TAGS = 40000
+LINEAR_BOUND_S = 1.0
+
+
+def assert_fast(fn, text):
+    start = time.perf_counter()
+    fn(text)
+    elapsed = time.perf_counter() - start
+    assert elapsed < LINEAR_BOUND_S, elapsed
+
+
+def test_many_unclosed_tags_scan_in_linear_time():
+    for prefix in ("<a ", "<iframe ", "<svg ", "<meta "):
+        assert_fast(lambda text: pipeline.detect_vectors(text, ALL_HITS), "<a onclick=x>" + prefix * UNCLOSED_TAGS)
+    assert pipeline.detect_vectors("<a onclick=x>" + "<a " * 100, ALL_HITS)["on_attr"] == 1
+
+
+def test_many_unclosed_table_tags_unwrap_in_linear_time():
+    for prefix in ("<td", "<tr", "<table"):
+        assert_fast(pipeline.unwrap_and_escape_code_fences, prefix * UNCLOSED_TAGS)
+
+
+def test_table_autowrap_matches_closed_tag_regex():
+    old = {name: re.compile(rf"<{name}[^>]*>", re.I) for name in ("table", "td", "tr")}
+    new = {"table": pipeline.TABLE_RE, "td": pipeline.TD_RE, "tr": pipeline.TR_RE}
+    samples = ["<td>x", "<td", "<td <b>", "<TD class=a", "x > <tr", "<tr><td>", "<table><td>x</td>",
+               "<td<td<td", "text", "<tr\n>", "> <td x"]
+    for text in samples:
+        for name in old:
+            assert pipeline._has_tag(new[name], text) == bool(old[name].search(text)), (name, text)
+    assert pipeline.unwrap_and_escape_code_fences("<td>x</td>") == "<table><tr><td>x</td></tr></table>"
+    assert pipeline.unwrap_and_escape_code_fences("<tr>x</tr>") == "<table><tr>x</tr></table>"
+
+
+def test_tag_patterns_still_match():
+    text = ('<img src=x onerror="alert(1)"><iframe srcdoc="<b>"></iframe>'
+            '<svg onload=alert(1)><meta http-equiv="refresh" content="0">')
+    counts = pipeline.detect_vectors(text, ALL_HITS)
+    assert counts["on_attr"] == 2
+    assert counts["iframe_srcdoc"] == 1
+    assert counts["svg_onload"] == 1
+    assert counts["meta_refresh"] == 1
+
+
+def test_strip_dangerous_attrs_leaves_nothing_to_strip():
+    # unlike the original single pass, the helper repeats until no pass matches, so on crafted raw
+    # input ('<a hrsrc="data:x"ef="javascript:...">') it strips more than the original did
+    for payload in SANITIZE_PAYLOADS:
+        out = pipeline._strip_dangerous_attrs(payload)
+        assert all(not pattern.search(out) for pattern, _ in OLD_SANITIZE_PASSES), payload
+    spliced = '<a hrsrc="data:x"ef="javascript:alert(1)">x</a>'
+    assert old_sanitize(spliced) == '<a href="javascript:alert(1)">x</a>'
+    assert pipeline._strip_dangerous_attrs(spliced) == '<a href="#">x</a>'
+
+
+def test_server_sanitize_matches_original_single_pass():
+    tags = ["b", "i", "u", "em", "strong", "p", "br", "ul", "ol", "li", "a", "h1", "h2", "img", "div", "span", "pre", "code"]
+    attrs = {"a": ["href", "title", "rel"], "img": ["src", "alt", "title"]}
+    for payload in SANITIZE_PAYLOADS:
+        expected = old_sanitize(pipeline.bleach.clean(payload, tags=tags, attributes=attrs, strip=True))
+        assert pipeline.server_sanitize(payload) == expected, payload
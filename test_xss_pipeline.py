@@ -0,0 +1,245 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+from ollama import ChatResponse, Message
+
+import xss_experiment_pipeline as pipeline
+
+ROOT = Path(__file__).parent
+FENCED = "Sure:\n```html\n<b onclick=\"x\">it's</b>\n```"
+
+
+def test_response_text_reads_message_content():
+    resp = ChatResponse(model="m", message=Message(role="assistant", content=FENCED))
+    assert pipeline._response_text(resp) == FENCED
+    assert pipeline._response_text({"message": {"content": FENCED}}) == FENCED
+    assert pipeline.unwrap_and_escape_code_fences(FENCED) == "<b onclick=\"x\">it's</b>"
+
+
+def test_legacy_extraction_keeps_repr_escapes():
+    # the published reports hold this form: no real newlines, so no code fence is unwrapped
+    resp = ChatResponse(model="m", message=Message(role="assistant", content=FENCED))
+    text = pipeline._legacy_response_text(resp)
+    assert text == repr(FENCED)[1:-1]
+    assert "\n" not in text
+    assert pipeline.unwrap_and_escape_code_fences(text) == text
+
+
+def test_unclosed_fence_unwraps_only_under_stop_sequences(monkeypatch):
+    unclosed = "Sure:\n```html\n<b>hi</b>\n"
+    assert pipeline.unwrap_and_escape_code_fences(unclosed) == unclosed
+    monkeypatch.setattr(pipeline, "STOP_SEQUENCES", pipeline.TERSE_STOP_SEQUENCES)
+    assert pipeline.unwrap_and_escape_code_fences(unclosed) == "<b>hi</b>"
+
+
+@pytest.fixture
+def fake_chat(monkeypatch):
+    calls = []
+
+    def chat(model, messages, options=None):
+        calls.append(messages[-1]["content"])
+        return {"message": {"content": "<b>reply</b>"}}
+
+    monkeypatch.setattr(pipeline, "chat", chat)
+    monkeypatch.setattr(pipeline, "_CACHE_CONN", None)
+    return calls
+
+
+def test_model_cache_is_off_by_default(fake_chat, monkeypatch):
+    monkeypatch.setattr(pipeline, "CACHE_PATH", "")
+    assert pipeline.call_model("p")[2] is False
+    assert pipeline.call_model("p")[2] is False
+    assert fake_chat == ["p", "p"]
+
+
+def test_model_cache_hit_skips_the_call(fake_chat, monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    text, _, hit = pipeline.call_model("p")
+    assert (text, hit) == ("<b>reply</b>", False)
+    assert pipeline.call_model("p") == ("<b>reply</b>", 0.0, True)
+    assert fake_chat == ["p"]
+    pipeline._CACHE_CONN.close()
+
+
+@pytest.mark.parametrize("model", ["deepseek", "llama"])
+def test_compute_metrics_reproduces_published_reports(model):
+    rows = json.loads((ROOT / f"xss_full_report-{model}.json").read_text(encoding="utf-8"))
+    expected = json.loads((ROOT / f"meta-{model}.json").read_text(encoding="utf-8"))["metrics"]
+    metrics = pipeline.compute_metrics(rows)
+    assert metrics == expected
+    assert list(metrics) == list(expected)
+    for key, value in expected.items():
+        if isinstance(value, dict):
+            assert list(metrics[key]) == list(value), key
+
+
+def _flag_columns(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return tuple(rng.random(n) < p for p in (0.3, 0.05, 0.02, 0.8))
+
+
+@pytest.mark.parametrize("n", [1, 7, 500])
+def test_metric_count_kernels_agree(n):
+    cols = _flag_columns(n)
+    expected = tuple(map(int, pipeline._metric_counts_loop(*cols)))
+    assert tuple(map(int, pipeline._metric_counts_np(*cols))) == expected
+
+
+def test_metric_counts_jit_matches_numpy_and_loop():
+    pytest.importorskip("numba")
+    kernel = pipeline._metric_counts_jit()
+    assert kernel is not None
+    for n in (1, 7, 500):
+        cols = _flag_columns(n, seed=n)
+        expected = tuple(map(int, pipeline._metric_counts_np(*cols)))
+        assert tuple(map(int, kernel(*cols))) == expected
+        assert tuple(map(int, pipeline._metric_counts_loop(*cols))) == expected
+
+
+def test_compute_metrics_numba_path_matches_report(monkeypatch):
+    pytest.importorskip("numba")
+    monkeypatch.setattr(pipeline, "NUMBA_MIN_ROWS", 1)
+    rows = json.loads((ROOT / "xss_full_report-llama.json").read_text(encoding="utf-8"))
+    expected = json.loads((ROOT / "meta-llama.json").read_text(encoding="utf-8"))["metrics"]
+    assert pipeline.compute_metrics(rows) == expected
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_jsonl_round_trip_keeps_surrogates_and_non_ascii(use_orjson, monkeypatch, tmp_path):
+    if not use_orjson:
+        monkeypatch.setattr(pipeline, "orjson", None)
+    elif pipeline.orjson is None:
+        pytest.skip("orjson not installed")
+    rows = [
+        {"prompt": "zażółć gęślą jaźń", "model_output": "<b>héllo ✓ 🙂</b>", "baseline_executed": True},
+        {"prompt": "split emoji", "model_output": "cut here \ud800", "client_sanitized_executed": None},
+        {"prompt": "both", "log": [{"snippet": "\udfff ünïcode"}], "model_latency_s": 1.5},
+    ]
+    src, dst = tmp_path / "rows.jsonl", tmp_path / "rows.json"
+    src.write_bytes(b"".join(pipeline._json_line(r) for r in rows))
+    pipeline.jsonl_to_json_array(src, dst)
+    text = dst.read_text(encoding="utf-8")
+    # rows without lone surrogates keep their non-ASCII text unescaped
+    assert "zażółć gęślą jaźń" in text and "🙂" in text
+    parsed = json.loads(text)
+    assert json.dumps(parsed, ensure_ascii=False) == json.dumps(rows, ensure_ascii=False)
+
+
+def test_jsonl_to_json_array_of_empty_file(tmp_path):
+    src, dst = tmp_path / "rows.jsonl", tmp_path / "rows.json"
+    src.write_bytes(b"")
+    pipeline.jsonl_to_json_array(src, dst)
+    assert json.loads(dst.read_text(encoding="utf-8")) == []
+
+
+@pytest.fixture
+def fake_run(monkeypatch, tmp_path):
+    """main() with the model and renders faked; returns {thread_name_prefix: max_workers} of its pools."""
+    pools = {}
+    real_executor = pipeline.ThreadPoolExecutor
+
+    def executor(max_workers=None, thread_name_prefix=""):
+        pools[thread_name_prefix] = max_workers
+        return real_executor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+    monkeypatch.setattr(pipeline, "ThreadPoolExecutor", executor)
+    monkeypatch.setattr(pipeline, "build_prompt_list", lambda n, **kw: [f"p{i}" for i in range(n)])
+    monkeypatch.setattr(pipeline, "call_model", lambda prompt: ("", 0.0, False))
+    monkeypatch.setattr(pipeline, "run_prompt_xss",
+                        lambda prompt, **kw: {"prompt": prompt, "model_latency_s": 0.0, "baseline_executed": False})
+    # creates the render pool without starting browsers
+    monkeypatch.setattr(pipeline, "warm_render_pool", lambda: pipeline._render_pool())
+    monkeypatch.setattr(pipeline, "RENDER_WORKERS", 3)
+    monkeypatch.setattr(pipeline, "_RENDER_POOL", None)
+    monkeypatch.setattr(pipeline, "_RENDER_POOL_SIZE", 0)
+    for name in ("JSONL_OUT", "JSON_OUT", "CSV_OUT", "META_OUT"):
+        monkeypatch.setattr(pipeline, name, tmp_path / getattr(pipeline, name).name)
+    yield pools
+    if pipeline._RENDER_POOL is not None:
+        pipeline._RENDER_POOL.shutdown()
+
+
+def test_main_writes_in_order_and_bounds_rows_ahead_of_a_stalled_prompt(fake_run, monkeypatch, tmp_path):
+    workers, model_workers = 2, 1
+    max_ahead = pipeline.REORDER_WINDOWS * (workers + model_workers)
+    started = []
+    release = threading.Event()
+
+    def run_prompt_xss(prompt, **kwargs):
+        i = int(prompt[1:])
+        started.append(i)
+        if i == 0:
+            # stall the first prompt until the driver has started everything it is allowed to
+            release.wait(timeout=2)
+            time.sleep(0.2)  # time for an unbounded driver to run further ahead
+            assert max(started) < max_ahead
+        elif len(started) >= max_ahead:
+            release.set()
+        return {"prompt": prompt, "model_latency_s": 0.0, "baseline_executed": False}
+
+    monkeypatch.setattr(pipeline, "run_prompt_xss", run_prompt_xss)
+    pipeline.main(n=40, workers=workers, model_workers=model_workers)
+    rows = json.loads((tmp_path / pipeline.JSON_OUT.name).read_text(encoding="utf-8"))
+    assert [r["prompt"] for r in rows] == [f"p{i}" for i in range(40)]
+    assert "error" not in rows[0]
+
+
+@pytest.mark.parametrize("workers, render_workers, expected", [
+    (1, None, 3),
+    (2, None, 6),
+    (8, None, pipeline.MAX_RENDER_WORKERS),
+    (8, 5, 5),
+])
+def test_main_caps_the_render_pool(fake_run, workers, render_workers, expected):
+    pipeline.main(n=3, workers=workers, render_workers=render_workers)
+    assert fake_run["render"] == expected
+    assert fake_run["prompt"] == workers
+
+
+def test_main_closes_progress_bar_on_error(fake_run, monkeypatch):
+    bars = []
+
+    class Progress(pipeline.tqdm):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            bars.append(self)  # the reference keeps __del__ from closing it for main
+
+    def broken_json_line(row):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(pipeline, "tqdm", Progress)
+    monkeypatch.setattr(pipeline, "_json_line", broken_json_line)
+    with pytest.raises(OSError):
+        pipeline.main(n=3)
+    assert bars and all(bar.disable for bar in bars)  # tqdm.close() sets disable
+
+
+def test_embedding_failure_falls_back_to_chat(fake_chat, monkeypatch, tmp_path, caplog):
+    def embeddings(model, prompt):
+        raise RuntimeError(f"model {model!r} not found")
+
+    monkeypatch.setattr(pipeline, "embeddings", embeddings)
+    monkeypatch.setattr(pipeline, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(pipeline, "SEMANTIC_CACHE", True)
+    monkeypatch.setattr(pipeline, "_EMBED_FAILED", threading.Event())
+    with caplog.at_level("WARNING", logger=pipeline.logger.name):
+        assert pipeline.call_model("p1")[::2] == ("<b>reply</b>", False)
+        assert pipeline.call_model("p2")[2] is False
+    assert fake_chat == ["p1", "p2"]
+    assert len([r for r in caplog.records if "embedding" in r.getMessage()]) == 1
+    pipeline._CACHE_CONN.close()
+
+
+def test_scan_text_cache_is_bounded_and_returns_copies():
+    pipeline._scan_cached.cache_clear()
+    counts, hit = pipeline.scan_text("<img src=x onerror=alert(1)>")
+    assert hit and counts["on_attr"] == 1
+    counts["on_attr"] = 99
+    assert pipeline.scan_text("<img src=x onerror=alert(1)>")[0]["on_attr"] == 1
+    for i in range(pipeline.SCAN_CACHE_SIZE + 10):
+        pipeline.scan_text(f"text {i}")
+    assert pipeline._scan_cached.cache_info().currsize == pipeline.SCAN_CACHE_SIZE